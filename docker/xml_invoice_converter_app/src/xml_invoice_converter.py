@@ -1,20 +1,27 @@
 # Standard library imports
 import os
 import logging
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+import queue
+import atexit
 from dotenv import load_dotenv
 import argparse
 import sys
-import io
+import asyncio
 import time
+import math
+import threading
+import tempfile
 from datetime import datetime
+from collections import defaultdict, namedtuple, OrderedDict
 
 # Third-party imports
 import pandas as pd
+import xlsxwriter
 #from pkg_resources import safe_name
-import xmltodict
+from lxml import etree
 from zoneinfo import ZoneInfo
-from nicegui import ui, app, nicegui
-import defusedxml.ElementTree as ET
+from nicegui import ui, app, run, nicegui
 import hashlib
 
 # Logger setup
@@ -29,6 +36,7 @@ APP_NAME = os.getenv('APP_NAME', 'XML_CONVERTER').upper()
 APP_CODE = os.getenv('APP_CODE', 'XIC').upper()
 APP_VERSION = os.getenv('APP_VERSION', '0.0.1')
 PROCESSING_TIMEOUT = int(os.getenv('PROCESSING_TIMEOUT', 30))
+EXCEL_FILE_TTL = 60  # secondi prima della rimozione del file Excel scaricato
 LOG_FILE = f'logs/{APP_CODE.lower()}_usage.log'
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
 TIMEZONE = ZoneInfo("Europe/Rome")
@@ -50,24 +58,69 @@ def parse_arguments():
     return parser.parse_args()
 
 # --- FUNZIONI DI SUPPORTO PER L'UPLOAD ---
+
+# Oltre questa soglia il file caricato viene spostato dalla RAM al disco
+SPOOL_MAX_SIZE = 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+    
+def scan_xml(xml_file):
+    """
+    Analizza in streaming (lxml.iterparse) il file XML caricato (Punto 6).
+    Ritorna: (DOCTYPE presente: bool, nome locale del tag radice: str,
+              profondità: int, righe DettaglioLinee: int)
+    Gli elementi sono liberati man mano: nessun albero completo in memoria.
+    La scansione si interrompe appena un controllo fallisce (DOCTYPE presente,
+    tag radice errato, profondità oltre MAX_XML_DEPTH, righe oltre MAX_LINES_PER_INVOICE).
+    """
+    has_doctype = False
+    root_tag = None
+    level = 0
+    depth = 0
+    num_items = 0
+    
+    xml_file.seek(0)
+    for event, element in etree.iterparse(xml_file, events=('start', 'end'), **XML_PARSER_OPTIONS):
+        if event == 'start':
+            level += 1
+            if level > depth:
+                depth = level
+                if depth > MAX_XML_DEPTH:
+                    break
+            if root_tag is None:
+                # Una FatturaPA non ha DTD: un DOCTYPE (con eventuali entità
+                # interne, che verrebbero espanse nel testo) viene rifiutato
+                if element.getroottree().docinfo.doctype:
+                    has_doctype = True
+                    break
+                root_tag = etree.QName(element).localname
+                if root_tag != 'FatturaElettronica':
+                    break
+        else:
+            level -= 1
+            # Confronto sul tag grezzo: QName a ogni evento costa più della scansione
+            tag = element.tag
+            if tag == 'DettaglioLinee' or tag.endswith('}DettaglioLinee'):
+                num_items += 1
+                if num_items > MAX_LINES_PER_INVOICE:
+                    break
+            element.clear(keep_tail=True)
+            while element.getprevious() is not None:
+                del element.getparent()[0]
     
-def get_xml_depth(element, level=1):
-    """Calcola la profondità dell'albero XML (Punto 6)."""
-    if not list(element):
-        return level
-    return max(get_xml_depth(child, level + 1) for child in element)
+    return has_doctype, root_tag, depth, num_items
 
 
 async def handle_upload(e, upload_widget, rows_label, notification_box, notification_icon, notification_label):
     """
     Esegue l'upload del file, valida il file e restituisce i dati.
-    Ritorna: (successo: bool, contenuto: bytes, nome: str, righe: int)
+    Ritorna: (successo: bool, file: SpooledTemporaryFile, nome: str, righe: int, hash: str)
     """
 
     # 1. INIZIALIZZAZIONE SICURA (Punto di partenza critico)
     safe_filename = "file_sconosciuto.xml"
     file_hash = "n/a"
     num_items = 0
+    spool = None
 
     try:
         # 2. RECUPERO NOME FILE REALE
@@ -88,26 +141,49 @@ async def handle_upload(e, upload_widget, rows_label, notification_box, notifica
         # Accesso sicuro al buffer
         buffer = getattr(e, 'content', getattr(e, 'file', None))
         if not buffer:
-            logger.error(f"UPLOAD FAILED | Nome rilevato: {safe_filename} | Buffer not found")
+            logger.error("UPLOAD FAILED | Nome rilevato: %s | Buffer not found", safe_filename)
             
             notification_icon.props('name=error color=negative')
             notification_label.set_text("Errore: impossibile leggere il contenuto del file")
             notification_box.classes('border-red-500 bg-red-100 dark:bg-red-900/40 opacity-100', remove='opacity-0')
             notification_box.set_visibility(True)
             
-            return False, None, safe_filename, num_items
-
-        # Lettura contenuto e calcolo Hash
-        byte_content = await buffer.read()
-        file_hash = hashlib.sha256(byte_content).hexdigest()
-
-        # Parsing Protetto (Anti-XML Bomb)
-        root = ET.fromstring(byte_content)
-        detail_lines = root.findall('.//{*}DettaglioLinee')
-        num_items = len(detail_lines)
+            return False, None, safe_filename, num_items, file_hash
+
+        # Copia su file temporaneo (RAM/disco) e calcolo Hash: a blocchi solo per
+        # i file grandi, i file piccoli (già in memoria) sono letti in un colpo solo
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        hasher = hashlib.sha256()
+        if hasattr(buffer, 'iterate') and buffer.size() > SPOOL_MAX_SIZE:
+            async for chunk in buffer.iterate(chunk_size=UPLOAD_CHUNK_SIZE):
+                hasher.update(chunk)
+                spool.write(chunk)
+        else:
+            chunk = await buffer.read()
+            hasher.update(chunk)
+            spool.write(chunk)
+        file_size = spool.tell()
+        file_hash = hasher.hexdigest()
+        spool.seek(0)
+
+        # Parsing Protetto in streaming (niente DTD esterne o accessi di rete)
+        has_doctype, root_tag, depth, num_items = scan_xml(spool)
+
+        # Controllo DOCTYPE (entità e DTD non ammesse)
+        if has_doctype:
+            error_msg = 'Invalid structure -> DOCTYPE declarations are not allowed'
+            
+            notification_icon.props('name=error color=negative')
+            notification_label.set_text(error_msg)
+            notification_box.classes('border-red-500 bg-red-100 dark:bg-red-900/40 opacity-100', remove='opacity-0')
+            notification_box.set_visibility(True)
+            
+            logger.warning("UPLOAD REJECTED | File: %s | Hash: %s | Cause: %s", safe_filename, file_hash, error_msg)
+            spool.close()
+            return False, None, safe_filename, num_items, file_hash
 
         # Controllo Tag (gestisce p:FatturaElettronica)
-        if 'FatturaElettronica' not in root.tag:
+        if root_tag != 'FatturaElettronica':
             error_msg = f'Invalid structure -> missing tag FatturaElettronica'
             
             notification_icon.props('name=error color=negative')
@@ -115,33 +191,35 @@ async def handle_upload(e, upload_widget, rows_label, notification_box, notifica
             notification_box.classes('border-red-500 bg-red-100 dark:bg-red-900/40 opacity-100', remove='opacity-0')
             notification_box.set_visibility(True)
             
-            logger.warning(f"UPLOAD REJECTED | File: {safe_filename} | Hash: {file_hash} | Cause: {error_msg}")
-            return False, None, safe_filename, num_items
+            logger.warning("UPLOAD REJECTED | File: %s | Hash: %s | Cause: %s", safe_filename, file_hash, error_msg)
+            spool.close()
+            return False, None, safe_filename, num_items, file_hash
 
         # Verifica Profondità dell'XML
-        depth = get_xml_depth(root)
         if depth > MAX_XML_DEPTH:
-            error_msg = f'XML too deep -> {depth} levels (Max {MAX_XML_DEPTH})'
+            error_msg = f'XML too deep -> more than {MAX_XML_DEPTH} levels'
             
             notification_icon.props('name=error color=negative')
             notification_label.set_text(error_msg)
             notification_box.classes('border-red-500 bg-red-100 dark:bg-red-900/40 opacity-100', remove='opacity-0')
             notification_box.set_visibility(True)
             
-            logger.warning(f"UPLOAD REJECTED | File: {safe_filename} | Hash: {file_hash} | Cause: {error_msg}")
-            return False, None, safe_filename, num_items
+            logger.warning("UPLOAD REJECTED | File: %s | Hash: %s | Cause: %s", safe_filename, file_hash, error_msg)
+            spool.close()
+            return False, None, safe_filename, num_items, file_hash
 
         # CONTROLLO RISPETTO AL LIMITE
         if num_items > MAX_LINES_PER_INVOICE:
-            error_msg = f'Limit exceeded -> {num_items} lines (Max {MAX_LINES_PER_INVOICE})'
+            error_msg = f'Limit exceeded -> more than {MAX_LINES_PER_INVOICE} lines'
             
             notification_icon.props('name=error color=negative')
             notification_label.set_text(error_msg)
             notification_box.classes('border-red-500 bg-red-100 dark:bg-red-900/40 opacity-100', remove='opacity-0')
             notification_box.set_visibility(True)
             
-            logger.warning(f"UPLOAD REJECTED | File: {safe_filename} | Hash: {file_hash} | Cause: {error_msg}")
-            return False, None, safe_filename, num_items
+            logger.warning("UPLOAD REJECTED | File: %s | Hash: %s | Cause: %s", safe_filename, file_hash, error_msg)
+            spool.close()
+            return False, None, safe_filename, num_items, file_hash
 
         # Se num_items è 0, facciamo un controllo di sicurezza
         if num_items == 0:
@@ -160,8 +238,9 @@ async def handle_upload(e, upload_widget, rows_label, notification_box, notifica
                                  remove='opacity-0 border-red-500 bg-red-100 border-yellow-500 bg-yellow-100')
         notification_box.set_visibility(True)
         
-        logger.info(f"UPLOAD SUCCESS | File: {safe_filename} | Hash: {file_hash} | Lines: {num_items}")
-        return True, byte_content, safe_filename, num_items
+        logger.info("UPLOAD SUCCESS | File: %s | Hash: %s | Size: %d bytes | Lines: %d",
+                    safe_filename, file_hash, file_size, num_items)
+        return True, spool, safe_filename, num_items, file_hash
     
     except Exception as ex:
         error_msg = f"{type(ex).__name__}: {str(ex)}"
@@ -170,8 +249,10 @@ async def handle_upload(e, upload_widget, rows_label, notification_box, notifica
         notification_label.set_text(f'Technical error: {str(ex)}')
         notification_box.classes('border-red-500 bg-red-100 dark:bg-red-900/40 opacity-100', remove='opacity-0')
         notification_box.set_visibility(True)       
-        logger.error(f"UPLOAD ERROR: {safe_filename} | Detail: {error_msg}")
-        return False, None, safe_filename, 0
+        logger.error("UPLOAD ERROR: %s | Detail: %s", safe_filename, error_msg)
+        if spool:
+            spool.close()
+        return False, None, safe_filename, 0, file_hash
 
 
 # --- FUNZIONI DI PARSING XML ---
@@ -179,36 +260,88 @@ async def handle_upload(e, upload_widget, rows_label, notification_box, notifica
 DEFAULT_VALUE = "**"
 DEFAULT_NUMERIC = "0"
 
-def extract_nested_value(data, path, default=None):
-    """Estrae valore da struttura dictionary annidata."""
-    current = data
+# Elementi letti in streaming dal parser (testata + righe)
+INVOICE_TAGS = ('{*}CedentePrestatore', '{*}DatiGeneraliDocumento', '{*}DettaglioLinee')
+
+# Opzioni di sicurezza del parser lxml: niente entità esterne, DTD esterne o accessi
+# di rete (i file con DOCTYPE sono rifiutati da scan_xml), limiti di libxml2 attivi
+# (huge_tree), nessuna tabella degli ID né nodi di soli spazi
+XML_PARSER_OPTIONS = {
+    'resolve_entities': False,
+    'no_network': True,
+    'load_dtd': False,
+    'dtd_validation': False,
+    'huge_tree': False,
+    'collect_ids': False,
+    'remove_blank_text': True
+}
+
+# Mappatura TipoDato degli allegati di riga -> campo
+ATTACHMENT_MAP = {
+    "DISEGNO": 'drawing_number',
+    "COMMESSA": 'order_number',
+    "N01": 'ddt_number',
+    "INTENTO": 'intent'
+}
+
+# Campi propagati dalle righe precedenti (energy contribution management)
+PROPAGATED_FIELDS = ('drawing_number', 'order_number', 'ddt_number')
+
+def child_map(element):
+    """
+    Figli diretti di un elemento per nome locale (indipendente dal namespace),
+    letti in un solo passaggio. A parità di nome resta il primo, come findtext.
+    """
+    children = {}
+    for child in element.iterchildren(etree.Element):
+        children.setdefault(child.tag.rpartition('}')[2], child)
+    return children
+
+
+def find_child(element, *path):
+    """Discende per nomi locali lungo i figli diretti (None se un passo manca)."""
+    for name in path:
+        if element is None:
+            return None
+        element = child_map(element).get(name)
+    return element
+
+
+def extract_text(element, default=None):
+    """Estrae il testo di un elemento XML (None se assente)."""
+    text = element.text if element is not None else None
+    if text:
+        text = text.strip()
+    return text or default or DEFAULT_VALUE
+
+
+def extract_number(element):
+    """Estrae il valore numerico di un elemento XML (0.0 se assente o non valido)."""
+    if element is None or not element.text:
+        return 0.0
     try:
-        for key in path:
-            current = current[key]
-        return str(current) if current is not None else (default or DEFAULT_VALUE)
-    except (KeyError, TypeError):
-        return default or DEFAULT_VALUE
-
-
-def extract_invoice_data(xml_dict, root_tag):
-    """Estrae dati di testata fattura."""
-    header = xml_dict[root_tag]["FatturaElettronicaHeader"]
-    body = xml_dict[root_tag]["FatturaElettronicaBody"]
-    general_data = body["DatiGenerali"]["DatiGeneraliDocumento"]
-    
-    invoice_data = {
-        'supplier_vat': extract_nested_value(
-            header, ["CedentePrestatore", "DatiAnagrafici", "IdFiscaleIVA", "IdCodice"]
-        ),
-        'supplier_name': extract_nested_value(
-            header, ["CedentePrestatore", "DatiAnagrafici", "Anagrafica", "Denominazione"]
-        ),
-        'doc_number': extract_nested_value(general_data, ["Numero"]),
-        'doc_date': extract_nested_value(general_data, ["Data"]),
-        'doc_amount': extract_nested_value(
-            general_data, ["ImportoTotaleDocumento"], DEFAULT_NUMERIC
-        )
-    }
+        value = float(element.text)
+    except ValueError:
+        return 0.0
+    # float() accetta anche NaN, INF e valori fuori scala (1e999)
+    return value if math.isfinite(value) else 0.0
+
+
+def extract_invoice_data(element, invoice_data):
+    """
+    Estrae dati di testata fattura.
+    I dati documento sono quelli del FatturaElettronicaBody corrente: in un lotto
+    con più documenti vengono sovrascritti a ogni nuovo DatiGeneraliDocumento.
+    """
+    if etree.QName(element).localname == 'CedentePrestatore':
+        anagrafici = find_child(element, 'DatiAnagrafici')
+        invoice_data['supplier_vat'] = extract_text(find_child(anagrafici, 'IdFiscaleIVA', 'IdCodice'))
+        invoice_data['supplier_name'] = extract_text(find_child(anagrafici, 'Anagrafica', 'Denominazione'))
+    else:
+        children = child_map(element)
+        invoice_data['doc_number'] = extract_text(children.get('Numero'))
+        invoice_data['doc_date'] = extract_text(children.get('Data'))
+        invoice_data['doc_amount'] = extract_number(children.get('ImportoTotaleDocumento'))
     
     return invoice_data
 
@@ -222,187 +355,274 @@ def process_attachments(attachments, manage_energy, previous_values):
         'intent': DEFAULT_VALUE
     }
     
-    if not attachments:
-        return apply_energy_management(result, manage_energy, previous_values)
-    
-    if isinstance(attachments, dict):
-        attachments = [attachments]
-    
-    mapping = {
-        "DISEGNO": 'drawing_number',
-        "COMMESSA": 'order_number',
-        "N01": 'ddt_number',
-        "INTENTO": 'intent'
-    }
-    
     for attachment in attachments:
-        if isinstance(attachment, dict) and "TipoDato" in attachment:
-            tipo = attachment["TipoDato"]
-            if tipo in mapping:
-                field = mapping[tipo]
-                result[field] = attachment.get("RiferimentoTesto", DEFAULT_VALUE)
+        children = child_map(attachment)
+        field = ATTACHMENT_MAP.get(extract_text(children.get('TipoDato')))
+        if field is not None:
+            result[field] = extract_text(children.get('RiferimentoTesto'))
     
     return apply_energy_management(result, manage_energy, previous_values)
 
 
 def apply_energy_management(result, manage_energy, previous_values):
     """Applica logica energy contribution management."""
-    if manage_energy:
-        for field in ['drawing_number', 'order_number', 'ddt_number']:
-            if result[field] == DEFAULT_VALUE:
-                result[field] = previous_values[field]
+    # I valori precedenti servono solo con la propagazione attiva
+    if not manage_energy:
+        return result
     
-    for field in ['drawing_number', 'order_number', 'ddt_number']:
-        if result[field] != DEFAULT_VALUE:
+    # Campo vuoto: eredita il valore precedente; altrimenti lo aggiorna
+    for field in PROPAGATED_FIELDS:
+        if result[field] == DEFAULT_VALUE:
+            result[field] = previous_values[field]
+        else:
             previous_values[field] = result[field]
     
     return result
 
 
-def parse_line(line, manage_energy, previous_values):
-    """Analizza singola riga fattura."""
-    article_code = DEFAULT_VALUE
-    if isinstance(line.get("CodiceArticolo"), dict):
-        article_code = line["CodiceArticolo"].get("CodiceValore", DEFAULT_VALUE)
-    
-    attachments = line.get("AltriDatiGestionali", [])
+# Riga fattura: tupla leggera (niente __dict__ per riga), con i dati del
+# documento di appartenenza (un file può contenere più documenti)
+LineData = namedtuple('LineData', [
+    'doc_number', 'doc_date', 'doc_amount', 'line_number', 'article_code', 'description', 'quantity', 'unit', 'unit_price',
+    'total_price', 'vat_code', 'drawing_number', 'order_number', 'ddt_number', 'intent'
+])
+
+def parse_line(line, invoice_data, manage_energy, previous_values):
+    """
+    Analizza singola riga fattura (figli letti una sola volta, per nome locale),
+    con i dati del documento di appartenenza (un file può contenere più documenti).
+    """
+    children = child_map(line)
+    attachments = line.iterchildren('{*}AltriDatiGestionali')
     attachment_data = process_attachments(attachments, manage_energy, previous_values)
     
-    line_data = {
-        'line_number': str(line.get("NumeroLinea", DEFAULT_VALUE)),
-        'article_code': article_code,
-        'description': line.get("Descrizione", DEFAULT_VALUE),
-        'quantity': str(line.get("Quantita", DEFAULT_NUMERIC)),
-        'unit': line.get("UnitaMisura", DEFAULT_VALUE),
-        'unit_price': str(line.get("PrezzoUnitario", DEFAULT_NUMERIC)),
-        'total_price': str(line.get("PrezzoTotale", DEFAULT_NUMERIC)),
-        'vat_code': str(line.get("AliquotaIVA", DEFAULT_NUMERIC)),
-        'drawing_number': attachment_data['drawing_number'],
-        'order_number': attachment_data['order_number'],
-        'ddt_number': attachment_data['ddt_number'],
-        'intent': attachment_data['intent']
-    }
+    line_data = LineData(
+        doc_number=invoice_data['doc_number'],
+        doc_date=invoice_data['doc_date'],
+        doc_amount=invoice_data['doc_amount'],
+        line_number=extract_text(children.get('NumeroLinea')),
+        article_code=extract_text(find_child(children.get('CodiceArticolo'), 'CodiceValore')),
+        description=extract_text(children.get('Descrizione')),
+        quantity=extract_number(children.get('Quantita')),
+        unit=extract_text(children.get('UnitaMisura')),
+        unit_price=extract_number(children.get('PrezzoUnitario')),
+        total_price=extract_number(children.get('PrezzoTotale')),
+        vat_code=extract_text(children.get('AliquotaIVA'), DEFAULT_NUMERIC),
+        drawing_number=attachment_data['drawing_number'],
+        order_number=attachment_data['order_number'],
+        ddt_number=attachment_data['ddt_number'],
+        intent=attachment_data['intent']
+    )
     
     return line_data
 
 
-def extract_lines_data(xml_dict, root_tag, manage_energy):
-    """Estrae dati righe fattura."""
-    lines = xml_dict[root_tag]["FatturaElettronicaBody"]["DatiBeniServizi"]["DettaglioLinee"]
-    
-    if not isinstance(lines, list):
-        lines = [lines]
-    
-    previous_values = {
-        'drawing_number': DEFAULT_VALUE,
-        'order_number': DEFAULT_VALUE,
-        'ddt_number': DEFAULT_VALUE
-    }
-    
-    result = []
-    for line in lines:
-        line_data = parse_line(line, manage_energy, previous_values)
-        result.append(line_data)
-    
-    return result
+# Dati di testata di default (campi assenti nel file)
+INVOICE_DEFAULTS = {
+    'supplier_vat': DEFAULT_VALUE,
+    'supplier_name': DEFAULT_VALUE,
+    'doc_number': DEFAULT_VALUE,
+    'doc_date': DEFAULT_VALUE,
+    'doc_amount': 0.0
+}
 
+def extract_lines_data(xml_file, manage_energy, invoice_data):
+    """
+    Estrae in streaming (lxml.iterparse) testata e righe fattura.
+    I dati di testata vengono scritti in invoice_data, le righe restituite
+    una alla volta (generatore) con i dati del documento corrente. Ogni elemento
+    viene liberato subito dopo l'elaborazione, per cui la memoria occupata non
+    cresce con il numero di righe.
+    """
+    previous_values = dict.fromkeys(PROPAGATED_FIELDS, DEFAULT_VALUE)
+    
+    xml_file.seek(0)
+    context = etree.iterparse(
+        xml_file, events=('end',), tag=INVOICE_TAGS, **XML_PARSER_OPTIONS
+    )
+    for _, element in context:
+        localname = etree.QName(element).localname
+        if localname == 'DettaglioLinee':
+            yield parse_line(element, invoice_data, manage_energy, previous_values)
+        else:
+            extract_invoice_data(element, invoice_data)
+            # Nuovo documento: i valori energy non passano da un documento all'altro
+            if localname == 'DatiGeneraliDocumento':
+                previous_values = dict.fromkeys(PROPAGATED_FIELDS, DEFAULT_VALUE)
+        
+        # Rilascio elementi già elaborati
+        element.clear(keep_tail=True)
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+# Mappatura campi riga -> colonne DataFrame
+LINE_COLUMNS = {
+    'doc_number': 'T_num_doc',
+    'doc_date': 'T_data_doc',
+    'doc_amount': 'T_importo_doc',
+    'line_number': 'P_nr_linea',
+    'article_code': 'P_codart',
+    'description': 'P_desc_linea',
+    'quantity': 'P_qta',
+    'unit': 'P_um',
+    'unit_price': 'P_przunit',
+    'total_price': 'P_prezzo_tot',
+    'vat_code': 'P_codiva',
+    'drawing_number': 'P_nrdisegno',
+    'order_number': 'P_commessa',
+    'ddt_number': 'P_nrddt',
+    'intent': 'P_intento'
+}
+
+# Colonne con pochi valori distinti, memorizzate come categoria
+CATEGORY_COLUMNS = ['T_num_doc', 'T_data_doc', 'P_um', 'P_codiva', 'P_intento']
 
 def create_dataframe(invoice_data, lines_data, filename):
     """Crea DataFrame dai dati parsati."""
     if not lines_data:
         return pd.DataFrame()
     
-    num_lines = len(lines_data)
+    # Colonne di riga costruite in un solo passaggio sulle tuple
+    df = pd.DataFrame.from_records(lines_data, columns=LineData._fields)
+    df.rename(columns=LINE_COLUMNS, inplace=True)
     
-    data = {
-        'T_filein': [filename] * num_lines,
-        'T_piva_mitt': [invoice_data['supplier_vat']] * num_lines,
-        'T_ragsoc_mitt': [invoice_data['supplier_name']] * num_lines,
-        'T_num_doc': [invoice_data['doc_number']] * num_lines,
-        'T_data_doc': [invoice_data['doc_date']] * num_lines,
-        'T_importo_doc': [invoice_data['doc_amount']] * num_lines,
-        'P_nr_linea': [line['line_number'] for line in lines_data],
-        'P_codart': [line['article_code'] for line in lines_data],
-        'P_desc_linea': [line['description'] for line in lines_data],
-        'P_qta': [line['quantity'] for line in lines_data],
-        'P_um': [line['unit'] for line in lines_data],
-        'P_przunit': [line['unit_price'] for line in lines_data],
-        'P_prezzo_tot': [line['total_price'] for line in lines_data],
-        'P_codiva': [line['vat_code'] for line in lines_data],
-        'P_nrdisegno': [line['drawing_number'] for line in lines_data],
-        'P_commessa': [line['order_number'] for line in lines_data],
-        'P_nrddt': [line['ddt_number'] for line in lines_data],
-        'P_intento': [line['intent'] for line in lines_data]
+    # Colonne di file e cedente: valore unico, replicato su tutte le righe
+    # (come categoria a un solo valore, 1 byte per riga)
+    header = {
+        'T_filein': filename,
+        'T_piva_mitt': invoice_data['supplier_vat'],
+        'T_ragsoc_mitt': invoice_data['supplier_name']
     }
+    for position, (col, value) in enumerate(header.items()):
+        df.insert(position, col, pd.Categorical([value]).repeat(len(df)))
     
-    df = pd.DataFrame(data)
-    
-    # Conversione colonne numeriche
-    numeric_cols = ['T_importo_doc', 'P_qta', 'P_przunit', 'P_prezzo_tot']
-    for col in numeric_cols:
-        df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+    df[CATEGORY_COLUMNS] = df[CATEGORY_COLUMNS].astype('category')
     
     return df
 
 
-def apply_grouping(df):
-    """Applica grouping al DataFrame."""
-    grouping_fields = [
-        "T_filein", "T_num_doc", "T_data_doc",
-        "P_nrdisegno", "P_commessa", "P_nrddt", "P_intento"
-    ]
+GROUPING_FIELDS = [
+    "T_filein", "T_num_doc", "T_data_doc",
+    "P_nrdisegno", "P_commessa", "P_nrddt", "P_intento"
+]
+
+def group_lines(lines_data, filename):
+    """
+    Applica grouping alle righe durante lo streaming.
+    Somma il prezzo totale per chiave (documento + riferimenti di riga) senza
+    costruire il DataFrame di dettaglio; i gruppi restano nell'ordine di prima
+    comparsa nel file (nessun ordinamento).
+    """
+    totals = defaultdict(float)
+    for line in lines_data:
+        key = (line.doc_number, line.doc_date,
+               line.drawing_number, line.order_number, line.ddt_number, line.intent)
+        totals[key] += line.total_price
+    
+    if not totals:
+        return pd.DataFrame()
     
-    df_grouped = df.groupby(grouping_fields, as_index=False).agg({
-        "P_prezzo_tot": "sum"
-    })
-    df_grouped = df_grouped.rename(columns={"P_prezzo_tot": "P_importo"})
+    df_grouped = pd.DataFrame(
+        [(filename,) + key + (total,) for key, total in totals.items()],
+        columns=GROUPING_FIELDS + ["P_importo"]
+    )
     df_grouped["P_importo"] = df_grouped["P_importo"].round(2)
     
     return df_grouped
 
 
-def convert_xml_to_df(xml_content, filename, use_grouping, manage_energy):
+def convert_xml_to_df(xml_file, filename, use_grouping, manage_energy):
     """
     Logica di conversione da XML a DataFrame Pandas.
     Viene chiamata al click sul bottone RUN.
     """
-    logger.info(f"Avvio conversione | Grouping: {use_grouping} | Energy: {manage_energy}")
+    logger.info("Avvio conversione | Grouping: %s | Energy: %s", use_grouping, manage_energy)
     
     try:
-        # Parse XML con xmltodict
-        xml_dict = xmltodict.parse(xml_content.decode('utf-8'))
-        root_tag = next(iter(xml_dict))
-        
-        # Estrazione dati testata
-        invoice_data = extract_invoice_data(xml_dict, root_tag)
+        # Estrazione dati testata e righe (parsing in streaming con lxml)
+        invoice_data = dict(INVOICE_DEFAULTS)
+        lines_data = extract_lines_data(xml_file, manage_energy, invoice_data)
         
-        # Estrazione dati righe
-        lines_data = extract_lines_data(xml_dict, root_tag, manage_energy)
-        
-        # Creazione DataFrame
-        df = create_dataframe(invoice_data, lines_data, filename)
-        
-        # Applicazione grouping se richiesto
-        if use_grouping and not df.empty:
-            df = apply_grouping(df)
+        if use_grouping:
+            # Grouping in streaming, senza DataFrame di dettaglio
+            df = group_lines(lines_data, filename)
+        else:
+            # Creazione DataFrame
+            df = create_dataframe(invoice_data, list(lines_data), filename)
         
-        logger.info(f"Conversion completed | Lines: {len(df)}")
+        logger.info("Conversion completed | Lines: %d", len(df))
         return df
         
     except Exception as e:
-        logger.error(f"Error during conversion: {e}", exc_info=True)
+        logger.error("Error during conversion: %s", e, exc_info=True)
         raise
 
 
-def create_excel_buffer(df, sheet_name="Invoice"):
-    """Crea file Excel in memory buffer."""
-    buffer = io.BytesIO()
+# Cache delle conversioni: (hash file, nome, grouping, energy) -> DataFrame.
+# In script mode NiceGUI riesegue il modulo a ogni caricamento pagina: la cache
+# vive sull'oggetto app ed è creata una sola volta per processo
+CONVERSION_CACHE_SIZE = 8
+if not hasattr(app, 'conversion_cache'):
+    app.conversion_cache = OrderedDict()
+    app.conversion_cache_lock = threading.Lock()
+
+def convert_xml_to_df_cached(file_hash, xml_file, filename, use_grouping, manage_energy):
+    """
+    Come convert_xml_to_df, ma riusa il risultato se lo stesso file è già stato
+    convertito con gli stessi parametri (cache LRU in memoria, condivisa tra le sessioni).
+    """
+    cache = app.conversion_cache
+    key = (file_hash, filename, use_grouping, manage_energy)
+    with app.conversion_cache_lock:
+        df = cache.get(key)
+        if df is not None:
+            cache.move_to_end(key)
+    if df is not None:
+        logger.info("Conversion cache hit | File: %s | Hash: %s", filename, file_hash[:16])
+        return df
     
-    with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-        df.to_excel(writer, sheet_name=sheet_name, index=False)
-        
-        workbook = writer.book
-        worksheet = writer.sheets[sheet_name]
+    df = convert_xml_to_df(xml_file, filename, use_grouping, manage_energy)
+    with app.conversion_cache_lock:
+        cache[key] = df
+        if len(cache) > CONVERSION_CACHE_SIZE:
+            cache.popitem(last=False)
+    
+    return df
+
+
+def dataframe_to_rows(df):
+    """
+    Converte il DataFrame nelle righe (dict) della tabella UI.
+    Lavora per colonne (Series.tolist dà già tipi Python nativi), più rapido di to_dict('records').
+    """
+    columns = df.columns.tolist()
+    values = [df[col].tolist() for col in columns]
+    return [dict(zip(columns, row)) for row in zip(*values)]
+
+
+def dataframe_page(df, page, rows_per_page):
+    """Righe della pagina richiesta dalla tabella UI (rows_per_page = 0: tutte le righe)."""
+    if not rows_per_page:
+        return dataframe_to_rows(df)
+    start = (page - 1) * rows_per_page
+    return dataframe_to_rows(df.iloc[start:start + rows_per_page])
+
+
+def create_excel_file(df, sheet_name="Invoice"):
+    """
+    Crea file Excel temporaneo su disco e ne ritorna il percorso (da rimuovere dopo l'uso).
+    Il foglio è scritto riga per riga in modalità constant_memory di xlsxwriter
+    (solo la riga corrente resta in RAM); df.to_excel non è compatibile con
+    questa modalità perché scrive le celle per colonna.
+    """
+    fd, path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(fd)
+    
+    try:
+        # nan_inf_to_errors: NaN/INF scritti come errori Excel invece di sollevare TypeError
+        workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'nan_inf_to_errors': True})
+        worksheet = workbook.add_worksheet(sheet_name)
         
         header_format = workbook.add_format({
             'bold': True,
@@ -411,28 +631,74 @@ def create_excel_buffer(df, sheet_name="Invoice"):
             'border': 1
         })
         
-        for col_num, value in enumerate(df.columns.values):
-            worksheet.write(0, col_num, value, header_format)
+        worksheet.set_column(0, len(df.columns) - 1, 18)
+        worksheet.write_row(0, 0, df.columns.tolist(), header_format)
+        for row_num, row in enumerate(df.itertuples(index=False, name=None), start=1):
+            worksheet.write_row(row_num, 0, row)
+        
+        workbook.close()
+    except Exception:
+        # Nessun file temporaneo orfano se la scrittura fallisce
+        remove_file(path)
+        raise
     
-    buffer.seek(0)
-    return buffer.getvalue()
+    return path
 
 
+def remove_file(path):
+    """Rimuove un file temporaneo, se ancora presente."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# Ultimo timestamp formattato: (secondo epoch, stringa)
+timestamp_cache = (None, "")
+
+def format_timestamp():
+    """Restituisce data e ora correnti, formattate una sola volta per secondo."""
+    global timestamp_cache
+    now = int(time.time())
+    if timestamp_cache[0] != now:
+        timestamp_cache = (now, datetime.fromtimestamp(now, TIMEZONE).strftime("%Y-%m-%d %H:%M:%S"))
+    return timestamp_cache[1]
+
+
+# Logger dedicato al log di utilizzo: un solo file aperto (al primo record),
+# con rotazione per evitare una crescita illimitata. Le scritture su file
+# avvengono in un thread dedicato, alimentato da una coda, per non
+# bloccare l'event loop della UI.
+# NiceGUI (script mode) riesegue il modulo a ogni caricamento pagina, mentre
+# i logger sono globali al processo: coda, thread e file vengono creati una sola volta.
+usage_logger = logging.getLogger(f"{__name__}.usage")
+if not usage_logger.handlers:
+    usage_logger.setLevel(logging.INFO)
+    usage_logger.propagate = False
+    usage_handler = RotatingFileHandler(
+        LOG_FILE, maxBytes=10_000_000, backupCount=3, encoding='utf-8', delay=True
+    )
+    usage_handler.setFormatter(logging.Formatter('%(message)s'))
+    usage_listener = QueueListener(queue.SimpleQueue(), usage_handler)
+    usage_logger.addHandler(QueueHandler(usage_listener.queue))
+    usage_listener.start()
+    # Svuota la coda e chiude il file all'uscita del processo
+    atexit.register(usage_listener.stop)
+
 def log_usage(filename, status="COMPLETED", message="", action="PROCESS", file_hash=""):
     """Log application usage."""
     try:
-        timestamp = datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M:%S")
+        timestamp = format_timestamp()
         
         log_line = (
             f"{timestamp} | {APP_NAME} | {APP_CODE} | {action} | "
-            f"{filename} | {status} | {message} | {file_hash}\n"
+            f"{filename} | {status} | {message} | {file_hash}"
         )
         
-        with open(LOG_FILE, 'a', encoding='utf-8') as f:
-            f.write(log_line)
+        usage_logger.info(log_line)
         
     except Exception as e:
-        logger.error(f"Error logging usage: {e}", exc_info=True)
+        logger.error("Error logging usage: %s", e, exc_info=True)
 
 # Funzione per ottenere la data di modifica del file
 def get_last_update():
@@ -444,7 +710,7 @@ def get_last_update():
             return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
         return 'N/A'
     except Exception as e:
-        logger.error(f"Error getting last update date: {e}")
+        logger.error("Error getting last update date: %s", e)
         return 'N/A'
 
 if __name__ in {"__main__", "__mp_main__"}:
@@ -468,7 +734,9 @@ if __name__ in {"__main__", "__mp_main__"}:
             format='%(asctime)s - %(name)s - %(funcName)s - %(levelname)s - %(message)s',
             datefmt='%Y-%m-%d %H:%M:%S',
             handlers=[
-                logging.FileHandler(LOG_FILE),
+                # Scrive su LOG_FILE tramite la coda del log di utilizzo: un solo
+                # RotatingFileHandler per il file (nessun handler su file già ruotati)
+                QueueHandler(usage_logger.handlers[0].queue),
                 logging.StreamHandler()
             ]
         )
@@ -478,8 +746,8 @@ if __name__ in {"__main__", "__mp_main__"}:
     
     # Log di startup
     if not hasattr(app.storage.general, '_startup_logged'):
-        logger.info(f"Starting {APP_NAME} on host {args.host}:{args.port}")
-        logger.info(f'Environment: {"Docker" if os.path.exists("/.dockerenv") else "Local"}')
+        logger.info("Starting %s on host %s:%s", APP_NAME, args.host, args.port)
+        logger.info("Environment: %s", "Docker" if os.path.exists("/.dockerenv") else "Local")
         app.storage.general._startup_logged = True
 
     # Detect environment
@@ -574,10 +842,12 @@ if __name__ in {"__main__", "__mp_main__"}:
     
     # --- STATO DELL'APPLICAZIONE ---
     app_state = {
-        'xml_content': None, 
+        'xml_file': None, 
         'xml_filename': None,
+        'xlsx_filename': None,
         'dataframe': None,
-        'file_hash': None
+        'file_hash': None,
+        'file_hash_short': None
     }
 
     # --- UI: CARD UPLOAD ---
@@ -650,11 +920,15 @@ if __name__ in {"__main__", "__mp_main__"}:
 # --- FUNZIONE DI RESET COMPLETO ---
     def clear_upload():
         """Cancella il file caricato e resetta l'interfaccia"""
-        logger.info(f"FILE CLEARED BY USER | File: {app_state['xml_filename']}")        
-        app_state['xml_content'] = None
+        logger.info("FILE CLEARED BY USER | File: %s", app_state['xml_filename'])        
+        if app_state['xml_file']:
+            app_state['xml_file'].close()
+        app_state['xml_file'] = None
         app_state['xml_filename'] = None
+        app_state['xlsx_filename'] = None
         app_state['dataframe'] = None
         app_state['file_hash'] = None
+        app_state['file_hash_short'] = None
         rows_label.set_text('File: none (0 lines)')
         upload_widget.reset()
         clear_btn.set_visibility(False)
@@ -667,11 +941,11 @@ if __name__ in {"__main__", "__mp_main__"}:
 
 
 # --- FUNZIONE DI ELABORAZIONE ---
-    def on_run_click():
+    async def on_run_click():
         """Elabora il file XML caricato."""
         result_container.clear()
         
-        if not app_state['xml_content']:
+        if not app_state['xml_file']:
             ui.notify('Nessun file caricato', type='warning')
             return
         
@@ -681,15 +955,27 @@ if __name__ in {"__main__", "__mp_main__"}:
                 ui.label('⏳ Elaborazione in corso...').classes('text-lg font-bold')
                 ui.spinner(size='lg')
         
+        # Parametri letti prima dell'elaborazione: sono quelli effettivamente usati
+        use_grouping = group_sw.value
+        manage_energy = energy_sw.value
+        
+        # Durante l'elaborazione il file non può essere rimosso o sostituito
+        # (il thread sta leggendo lo spool) né i parametri modificati
+        for control in (run_btn, group_sw, energy_sw, clear_btn, upload_widget):
+            control.disable()
+        
         try:
             start_time = time.time()
             
-            # Conversione XML -> DataFrame
-            df = convert_xml_to_df(
-                app_state['xml_content'],
+            # Conversione XML -> DataFrame in un thread separato:
+            # l'event loop resta libero di aggiornare la UI (spinner)
+            df = await run.io_bound(
+                convert_xml_to_df_cached,
+                app_state['file_hash'],
+                app_state['xml_file'],
                 app_state['xml_filename'],
-                group_sw.value,
-                energy_sw.value
+                use_grouping,
+                manage_energy
             )
             
             processing_time = time.time() - start_time
@@ -707,9 +993,9 @@ if __name__ in {"__main__", "__mp_main__"}:
             log_usage(
                 filename=app_state['xml_filename'],
                 status="COMPLETED",
-                message=f"Processed in {processing_time:.2f}s, grouping={group_sw.value}, energy={energy_sw.value}",
+                message=f"Processed in {processing_time:.2f}s, grouping={use_grouping}, energy={manage_energy}",
                 action="PROCESS",
-                file_hash=app_state['file_hash'][:16] if app_state['file_hash'] else ""
+                file_hash=app_state['file_hash_short']
             )
             
             # Mostra risultati
@@ -736,22 +1022,34 @@ if __name__ in {"__main__", "__mp_main__"}:
                     ui.separator()
                     
                     # Tabella dati con paginazione
-                    columns = [{'name': col, 'label': col, 'field': col, 'align': 'left'} for col in df.columns]
-                    rows = df.to_dict('records')
+                    columns = [{'name': col, 'label': col, 'field': col, 'align': 'left'} for col in df.columns.tolist()]
                     
-                    ui.table(
+                    # Paginazione lato server: al client arriva solo la pagina visualizzata
+                    # (righe già nell'ordine del file, nessun ordinamento)
+                    pagination = {'page': 1, 'rowsPerPage': 20, 'rowsNumber': len(df)}
+                    table = ui.table(
                         columns=columns,
-                        rows=rows,
+                        rows=dataframe_page(df, 1, 20),
                         row_key='T_num_doc',
-                        pagination={'rowsPerPage': 20, 'sortBy': 'P_nr_linea'}
+                        pagination=pagination
                     ).classes('w-full')
                     
+                    def on_table_request(e):
+                        """Carica la pagina richiesta dalla tabella."""
+                        requested = e.args['pagination']
+                        table.rows = dataframe_page(df, requested['page'], requested['rowsPerPage'])
+                        table.pagination = {**requested, 'rowsNumber': len(df)}
+                    
+                    table.on('request', on_table_request)
+                    
                     ui.separator()
                     
                     # Bottone download Excel
-                    def download_excel():
-                        excel_data = create_excel_buffer(df)
-                        filename_out = app_state['xml_filename'].replace(".xml", ".xlsx")
+                    async def download_excel():
+                        filename_out = app_state['xlsx_filename']
+                        file_hash = app_state['file_hash_short']
+                        # Scrittura del file Excel in un thread: l'event loop resta libero
+                        excel_path = await run.io_bound(create_excel_file, df)
                         
                         # Log download
                         log_usage(
@@ -759,22 +1057,25 @@ if __name__ in {"__main__", "__mp_main__"}:
                             status="COMPLETED",
                             message="Excel file downloaded",
                             action="DOWNLOAD",
-                            file_hash=app_state['file_hash'][:16] if app_state['file_hash'] else ""
+                            file_hash=file_hash
                         )
                         
-                        ui.download(excel_data, filename_out)
+                        # Il file viene servito da disco (FileResponse) e rimosso
+                        # dopo EXCEL_FILE_TTL secondi, anche se mai scaricato
+                        ui.download.file(excel_path, filename_out)
+                        asyncio.get_running_loop().call_later(EXCEL_FILE_TTL, remove_file, excel_path)
                         ui.notify('✅ Excel file downloaded successfully!', type='positive')
                     
                     ui.button('⬇️ DOWNLOAD EXCEL FILE', on_click=download_excel).classes('w-full py-4').props('color=primary size=lg')
                 
                 # Footer con timestamp
                 with ui.card().classes('w-full shadow-lg border border-gray-200 mt-4'):
-                    timestamp = datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M:%S")
+                    timestamp = format_timestamp()
                     ui.label('📋 PROCESS LOG').classes('font-bold text-lg mb-2')
                     ui.label(f'✅ Elaboration completed successfully at {timestamp}').classes('text-green-600')
         
         except Exception as e:
-            logger.error(f"Error during elaboration: {e}", exc_info=True)
+            logger.error("Error during elaboration: %s", e, exc_info=True)
             result_container.clear()
             with result_container:
                 with ui.card().classes('w-full shadow-lg border border-red-500'):
@@ -782,12 +1083,16 @@ if __name__ in {"__main__", "__mp_main__"}:
                     ui.label(f'An error occurred during processing:').classes('mb-2')
                     ui.label(str(e)).classes('text-sm font-mono bg-red-50 p-3 rounded')
                 ui.notify(f'❌ Errore: {str(e)}', type='negative')
+        
+        finally:
+            for control in (run_btn, group_sw, energy_sw, clear_btn, upload_widget):
+                control.enable()
 
 
 # --- LOGICA DI COORDINAMENTO ---
     async def process_file(e):
         # 1. Estrae i dati dall'evento
-        success, content, name, rows = await handle_upload(
+        success, content, name, rows, file_hash = await handle_upload(
             e, upload_widget, rows_label, notification_box, notification_icon, notification_label
         )
         
@@ -796,17 +1101,20 @@ if __name__ in {"__main__", "__mp_main__"}:
         
         # 3. Test e attivazione UI
         if success:
-            app_state['xml_content'] = content
+            if app_state['xml_file']:
+                app_state['xml_file'].close()
+            app_state['xml_file'] = content
             app_state['xml_filename'] = name
-            app_state['file_hash'] = hashlib.sha256(content).hexdigest()
+            # Nome del file Excel e hash breve (per i log) calcolati una sola volta
+            app_state['xlsx_filename'] = os.path.splitext(name)[0] + '.xlsx'
+            # Hash SHA-256 già calcolato a blocchi durante l'upload
+            app_state['file_hash'] = file_hash
+            app_state['file_hash_short'] = file_hash[:16]
             
             # Abilita la card parametri
             group_sw.enable()
             energy_sw.enable()
             run_btn.enable()
-            
-            # Collega l'azione al tasto RUN
-            run_btn.on('click', on_run_click, [])
         else:
             # Se fallisce, disabilita i parametri
             group_sw.disable()
@@ -815,6 +1123,8 @@ if __name__ in {"__main__", "__mp_main__"}:
 
     # Collega l'evento upload
     upload_widget.on_upload(process_file)
+    # Collega l'azione al tasto RUN una sola volta: il file corrente è letto da app_state
+    run_btn.on_click(on_run_click)
 
     ui.run(
         title=APP_NAME,